@@ -1,117 +1,314 @@
 import os
+
+# Must happen before anything touches sockets/ssl/threading. Enabled by the
+# gunicorn gevent worker (see gunicorn_conf.py).
+if os.environ.get("GEVENT_PATCH") == "1":
+    from gevent import monkey
+    monkey.patch_all()
+
 import time
 import json
+import collections
 import sqlite3
 import re
+import concurrent.futures
+import contextlib
+import queue
+import secrets
+import struct
 import threading
 import uuid
-import base64
-from flask import Flask, Response, stream_with_context, request, jsonify, g, send_file
-import requests
-from PIL import Image
+from flask import Flask, Response, stream_with_context, request, jsonify, send_from_directory
+import httpx
+from PIL import Image, ImageFile
 import io
 
+try:
+    # SIMD base64; auto-dispatches to AVX2/SSSE3 at import.
+    from pybase64 import b64encode as _b64encode
+except ImportError:
+    from base64 import b64encode as _b64encode
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
 # ==============================================================================
 # Database Setup
 # ==============================================================================
 DB = "chat_history.db"
-db_lock = threading.Lock()
+
+def _strip_think(s):
+    """Remove <think>...</think> spans case-insensitively in one pass.
+
+    The tags are literal and non-nested, so a find loop beats the regex
+    engine and allocates no match objects.
+    """
+    low = s.lower()
+    if '<think>' not in low:
+        return s.strip()
+    out = []
+    i = 0
+    while True:
+        a = low.find('<think>', i)
+        if a < 0:
+            out.append(s[i:])
+            break
+        b = low.find('</think>', a + 7)
+        if b < 0:
+            # Unterminated tag: keep the remainder, matching the old lazy
+            # regex which required a closing tag to strip anything.
+            out.append(s[i:])
+            break
+        out.append(s[i:a])
+        i = b + 8
+    return ''.join(out).strip()
+
+# Escape-free delta values extracted straight from the raw SSE bytes; any
+# backslash in the value makes this fail and we fall back to a JSON parse.
+_DELTA_RE = re.compile(rb'"delta"\s*:\s*"([^"\\]*)"')
+
+# Per-session history cache so each /chat turn avoids the full SELECT +
+# regex scrub over the whole session. Bounded LRU with lazy TTL eviction
+# (no sweeper thread); entries are [messages, last_access, last_rowid]
+# triples, appended on save and dropped on any write the append path can't
+# mirror. The rowid stamp serves two purposes: appends that find the stamp
+# at or past their row invalidate instead of duplicating the turn, and
+# every hit is revalidated against the session's MAX(id) in the DB so a
+# turn handled by another gunicorn worker (each process has its own cache)
+# forces a rebuild instead of silently serving a stale history.
+_SESSION_CACHE = collections.OrderedDict()
+_SESSION_CACHE_MAX = 1024
+_SESSION_CACHE_TTL = 600
+_SC_LOCK = threading.Lock()
+
+def _cache_gc(now):
+    # Called under _SC_LOCK. Amortized: at most a few evictions per access,
+    # walking from the LRU end.
+    evicted = 0
+    while _SESSION_CACHE and evicted < 8:
+        sid, cached = next(iter(_SESSION_CACHE.items()))
+        if now - cached[1] <= _SESSION_CACHE_TTL:
+            break
+        del _SESSION_CACHE[sid]
+        evicted += 1
+
+def _cache_invalidate(sid):
+    with _SC_LOCK:
+        _SESSION_CACHE.pop(sid, None)
+
+def _cache_append(sid, role, msg, rowid, image_data=None, media_type=None):
+    entry = _row_to_message(role, msg, image_data, media_type)
+    if entry is None:
+        return
+    with _SC_LOCK:
+        cached = _SESSION_CACHE.get(sid)
+        if cached is None:
+            return
+        if cached[2] >= rowid:
+            # The entry was rebuilt from the DB after this row was written
+            # (or the row changed after the rebuild, for the placeholder
+            # flush); either way the append can't be trusted.
+            _SESSION_CACHE.pop(sid, None)
+            return
+        cached[0].append(entry)
+        cached[1] = time.monotonic()
+        cached[2] = rowid
 
 app = Flask(__name__)
 
-def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(DB, timeout=10, check_same_thread=False)
-        g.db.row_factory = sqlite3.Row
-    return g.db
+# SQLite allows exactly one writer at a time anyway, so all writes share one
+# connection behind a lock; reads come from a pool of read-only connections
+# that WAL lets proceed while a write is in flight.
+_writer_conn = None
+_writer_lock = threading.Lock()
+_READER_POOL = queue.LifoQueue(maxsize=8)
 
-@app.teardown_appcontext
-def close_db(error):
-    db = g.pop('db', None)
-    if db is not None:
-        db.close()
+def _connect(readonly=False):
+    if readonly:
+        conn = sqlite3.connect(f"file:{DB}?mode=ro", uri=True, timeout=10, check_same_thread=False, cached_statements=256)
+    else:
+        conn = sqlite3.connect(DB, timeout=10, check_same_thread=False, isolation_level=None, cached_statements=256)
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+@contextlib.contextmanager
+def _write():
+    global _writer_conn
+    with _writer_lock:
+        if _writer_conn is None:
+            _writer_conn = _connect()
+        # BEGIN IMMEDIATE takes the write lock up front, avoiding
+        # upgrade-deadlocks against the readers.
+        _writer_conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield _writer_conn
+        except Exception:
+            _writer_conn.execute("ROLLBACK")
+            raise
+        else:
+            _writer_conn.execute("COMMIT")
+
+@contextlib.contextmanager
+def _read():
+    try:
+        conn = _READER_POOL.get_nowait()
+    except queue.Empty:
+        conn = _connect(readonly=True)
+    try:
+        yield conn
+    finally:
+        try:
+            _READER_POOL.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
 def init_db():
-    with app.app_context():
-        db = get_db()
+    global _writer_conn
+    with _writer_lock:
+        if _writer_conn is None:
+            _writer_conn = _connect()
+        db = _writer_conn
+        # WAL lets readers proceed while a write is in flight and commits
+        # cost a single append to the log instead of two fsyncs.
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA temp_store=MEMORY")
+        db.execute("PRAGMA mmap_size=134217728")
+        # Every gunicorn worker runs this from post_fork, so all DDL must be
+        # idempotent and applied atomically: BEGIN IMMEDIATE serializes the
+        # workers and IF NOT EXISTS makes losing the race harmless.
+        db.execute("BEGIN IMMEDIATE")
         try:
-            db.execute("SELECT ts FROM chats LIMIT 1")
-        except sqlite3.OperationalError:
-            db.execute("DROP TABLE IF EXISTS chats")
             db.execute("""
-            CREATE TABLE chats(
+            CREATE TABLE IF NOT EXISTS chats(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 session_id TEXT,
                 role TEXT,
                 message TEXT,
                 image_data TEXT,
                 media_type TEXT,
+                image_id INTEGER,
                 ts DATETIME DEFAULT CURRENT_TIMESTAMP
             )""")
-            db.commit()
-
-def save_msg(sid, role, msg, image_data=None, media_type=None):
-    with db_lock:
-        db = get_db()
-        db.execute("INSERT INTO chats(session_id, role, message, image_data, media_type) VALUES (?,?,?,?,?)", (sid, role, msg, image_data, media_type))
-        db.commit()
-
-def update_last_bot_message(sid, new_content_chunk, is_code_block_open=False):
-    with db_lock:
-        db = get_db()
-        cursor = db.execute("SELECT id, message FROM chats WHERE session_id=? AND role='bot' ORDER BY ts DESC LIMIT 1", (sid,))
-        last_bot_msg = cursor.fetchone()
-        updated_message = ""
-        if last_bot_msg:
-            existing_message = last_bot_msg['message']
-            if is_code_block_open:
-                # If code block is open, append directly without extra fences
-                updated_message = existing_message + new_content_chunk
-            else:
-                # Normal append for non-code or closed code blocks
-                updated_message = existing_message + new_content_chunk
-            db.execute("UPDATE chats SET message=? WHERE id=?", (updated_message, last_bot_msg['id']))
+            # Image bytes live in their own BLOB table; chats carries only
+            # the id and pays the 33% base64 bloat lazily, when a payload
+            # needs it.
+            db.execute("""
+            CREATE TABLE IF NOT EXISTS chat_images(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                media_type TEXT,
+                data BLOB
+            )""")
+            # Migration for databases created before image_id existed.
+            try:
+                db.execute("ALTER TABLE chats ADD COLUMN image_id INTEGER")
+            except sqlite3.OperationalError as e:
+                if "duplicate column name" not in str(e):
+                    raise
+            db.execute("CREATE INDEX IF NOT EXISTS idx_chats_sid_ts ON chats(session_id, ts)")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
         else:
-            updated_message = new_content_chunk
-            save_msg(sid, "bot", updated_message)
-        db.commit()
-        return updated_message
+            db.execute("COMMIT")
+
+def save_msg(sid, role, msg, image_bytes=None, media_type=None):
+    with _write() as db:
+        image_id = None
+        if image_bytes is not None:
+            image_id = db.execute("INSERT INTO chat_images(media_type, data) VALUES (?,?)", (media_type, image_bytes)).lastrowid
+        rowid = db.execute("INSERT INTO chats(session_id, role, message, image_id) VALUES (?,?,?,?)", (sid, role, msg, image_id)).lastrowid
+    # The cached entry is the API-shaped message, which wants base64 anyway.
+    image_data = _b64encode(image_bytes).decode('ascii') if image_bytes is not None else None
+    _cache_append(sid, role, msg, rowid, image_data, media_type)
+
+def _row_to_message(role, message, image_data, media_type):
+    role = "assistant" if role == 'bot' else role
+    clean_message = _strip_think(message)
+
+    content = []
+    if clean_message:
+        content.append({"type": "text", "text": clean_message})
+
+    if image_data and media_type:
+        content.append({
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": media_type,
+                "data": image_data
+            }
+        })
+
+    if not content:
+        return None
+    if role == 'user' and any(c.get("type") == "image" for c in content):
+        return {'role': role, 'content': content}
+    return {'role': role, 'content': clean_message}
 
 def load_msgs(sid):
-    db = get_db()
-    cursor = db.execute("SELECT role, message, image_data, media_type FROM chats WHERE session_id=? ORDER BY ts ASC", (sid,))
-    messages = []
-    for row in cursor.fetchall():
-        role = "assistant" if row['role'] == 'bot' else row['role']
-        clean_message = re.sub(r'<think>[\s\S]*?</think>', '', row['message'], flags=re.IGNORECASE).strip()
-
-        content = []
-        if clean_message:
-            content.append({"type": "text", "text": clean_message})
-
-        if row['image_data'] and row['media_type']:
-            content.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": row['media_type'],
-                    "data": row['image_data']
-                }
-            })
+    with _SC_LOCK:
+        cached = _SESSION_CACHE.get(sid)
+        if cached is not None:
+            _SESSION_CACHE.move_to_end(sid)
+            snapshot = list(cached[0])
+            stamp = cached[2]
+    if cached is not None:
+        # Freshness check: one indexed MAX(id) lookup (still far cheaper
+        # than the rebuild below) catches rows written by other worker
+        # processes — and any same-process write the stamp missed.
+        with _read() as db:
+            db_last = db.execute("SELECT MAX(id) FROM chats WHERE session_id=?", (sid,)).fetchone()[0] or 0
+        if db_last == stamp:
+            with _SC_LOCK:
+                fresh = _SESSION_CACHE.get(sid)
+                if fresh is not None:
+                    fresh[1] = time.monotonic()
+            return snapshot
+        _cache_invalidate(sid)
 
-        if content:
-            if role == 'user' and any(c.get("type") == "image" for c in content):
-                 messages.append({'role': role, 'content': content})
-            else:
-                 messages.append({'role': role, 'content': clean_message})
+    messages = []
+    append = messages.append
+    last_id = 0
+    with _read() as db:
+        # Iterate the cursor directly: rows are converted as SQLite decodes
+        # pages instead of materializing the whole history first.
+        for row in db.execute(
+                "SELECT c.id, c.role, c.message, c.image_data, c.media_type, i.media_type AS img_media_type, i.data AS img_data "
+                "FROM chats c LEFT JOIN chat_images i ON i.id = c.image_id "
+                "WHERE c.session_id=? ORDER BY c.id ASC", (sid,)):
+            last_id = row['id']
+            image_data = row['image_data']
+            media_type = row['media_type']
+            if image_data is None and row['img_data'] is not None:
+                image_data = _b64encode(row['img_data']).decode('ascii')
+                media_type = row['img_media_type']
+            entry = _row_to_message(row['role'], row['message'], image_data, media_type)
+            if entry is not None:
+                append(entry)
 
+    now = time.monotonic()
+    with _SC_LOCK:
+        _SESSION_CACHE[sid] = [list(messages), now, last_id]
+        _SESSION_CACHE.move_to_end(sid)
+        while len(_SESSION_CACHE) > _SESSION_CACHE_MAX:
+            _SESSION_CACHE.popitem(last=False)
+        _cache_gc(now)
     return messages
 
 # ==============================================================================
 # API Integration Section
 # ==============================================================================
 
-claude_session = requests.Session()
 claude_headers = {
     'authority': 'ai-sdk-reasoning.vercel.app',
     'accept': '*/*',
@@ -130,113 +327,244 @@ claude_headers = {
     'user-agent': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Mobile Safari/537.36',
 }
 claude_url = 'https://ai-sdk-reasoning.vercel.app/api/chat'
+_TEXT_KIND = "text"
+
+# One multiplexed HTTP/2 connection pool shared by all concurrent streams,
+# so bursts of /chat requests don't each pay a TLS handshake. The browser
+# headers ride on the client so each request only adds the body.
+_upstream = httpx.Client(
+    http2=True,
+    headers=claude_headers,
+    timeout=httpx.Timeout(90.0, read=None),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+)
+
+# Recycle SSE read buffers across streams instead of growing a fresh
+# bytearray per request.
+_BUF_POOL = queue.LifoQueue(maxsize=32)
+
+def _get_buf():
+    try:
+        return _BUF_POOL.get_nowait()
+    except queue.Empty:
+        return bytearray()
+
+def _put_buf(buf):
+    del buf[:]
+    try:
+        _BUF_POOL.put_nowait(buf)
+    except queue.Full:
+        pass
+
+def _trim_overlap(delta, last_partial_line):
+    """Drop the part of a continuation's first delta that repeats the tail of
+    the message being continued."""
+    delta = delta.lstrip()
+    if delta.startswith(last_partial_line):
+        return delta[len(last_partial_line):]
+    if delta and last_partial_line.endswith(delta[0]):
+        return delta[1:]
+    return delta
 
 def stream_claude_sonnet(chat_history, is_reasoning_enabled, is_continuation=False, last_partial_line=None):
-    api_messages = []
-    for msg in chat_history:
-        if isinstance(msg['content'], list): # Handle multipart messages (text + image)
-            parts = msg['content']
-        else: # Handle text-only messages
-            parts = [{"type": "text", "text": msg['content']}]
-
-        api_messages.append({
-            "parts": parts,
-            "id": str(uuid.uuid4())[:12],
-            "role": msg['role']
-        })
+    # Content is either already multipart (text + image) or a plain string.
+    # Text-only turns wrap in a one-element tuple (serialized as a JSON
+    # array) to skip a list allocation per historical message.
+    api_messages = [{
+        "parts": msg['content'] if isinstance(msg['content'], list) else ({"type": _TEXT_KIND, "text": msg['content']},),
+        "id": secrets.token_hex(6),
+        "role": msg['role']
+    } for msg in chat_history]
 
     payload = {
         'selectedModelId': 'sonnet-3.7',
         'isReasoningEnabled': is_reasoning_enabled,
-        'id': str(uuid.uuid4())[:12],
+        'id': secrets.token_hex(6),
         'messages': api_messages,
         'trigger': 'submit-user-message',
     }
+    raw_buf = _get_buf()
     try:
-        with claude_session.post(claude_url, headers=claude_headers, json=payload, stream=True, timeout=90) as r:
+        with _upstream.stream("POST", claude_url, content=_json_dumps(payload)) as r:
             r.raise_for_status()
             code_block_open = False
             code_fence_count = 0
-            buffer = ""
-            for line in r.iter_lines():
-                if line:
-                    decoded = line.decode('utf-8')
-                    if decoded.startswith("data: "):
-                        decoded = decoded[6:]
-                    if decoded == "[DONE]":
+            seen_delta = False
+            # Read in large chunks and split SSE lines in-buffer: per-line
+            # iteration does many tiny reads and copies, which dominates CPU
+            # on long streams.
+            for chunk in r.iter_bytes(chunk_size=65536):
+                raw_buf += chunk
+                # Coalesce all deltas that arrived in this read into one
+                # yield, amortizing the downstream write per network read
+                # rather than per SSE event.
+                pending = []
+                while True:
+                    nl = raw_buf.find(b"\n")
+                    if nl == -1:
+                        break
+                    line = bytes(raw_buf[:nl]).rstrip(b"\r")
+                    del raw_buf[:nl + 1]
+                    if not line:
                         continue
-                    try:
-                        data_json = json.loads(decoded)
-                        if data_json.get("type") == "text-delta":
-                            delta = data_json.get("delta", "")
-                            if delta:
-                                # Track code block state
-                                code_fence_count += delta.count('```')
-                                code_block_open = code_fence_count % 2 == 1
-                                if is_continuation and last_partial_line and buffer == "":
-                                    # Trim overlapping content and avoid extra whitespace
-                                    delta = delta.lstrip()
-                                    if delta.startswith(last_partial_line):
-                                        delta = delta[len(last_partial_line):]
-                                    elif last_partial_line.endswith(delta[0]):
-                                        delta = delta[1:]  # Skip the first character if it matches the last one
-                                buffer += delta
-                                yield delta, code_block_open
-                    except (json.JSONDecodeError, UnicodeDecodeError):
+                    if line.startswith(b"data: "):
+                        line = line[6:]
+                    if line == b"[DONE]" or b'"text-delta"' not in line:
                         continue
+                    m = _DELTA_RE.search(line)
+                    if m is not None:
+                        delta = m.group(1).decode('utf-8')
+                    else:
+                        try:
+                            data_json = _json_loads(line)
+                        except ValueError:
+                            continue
+                        if data_json.get("type") != "text-delta":
+                            continue
+                        delta = data_json.get("delta", "")
+                    if not delta:
+                        continue
+                    # Track code block state; most deltas carry no backtick,
+                    # so gate the fence count behind a single memchr.
+                    if '`' in delta:
+                        code_fence_count += delta.count('```')
+                        code_block_open = (code_fence_count & 1) == 1
+                    if is_continuation and last_partial_line and not seen_delta:
+                        delta = _trim_overlap(delta, last_partial_line)
+                    seen_delta = seen_delta or bool(delta)
+                    pending.append(delta)
+                if pending:
+                    yield ''.join(pending), code_block_open
     except Exception as e:
         yield f"🚨 Claude API Error: {str(e)}", False
+    finally:
+        _put_buf(raw_buf)
+
+# Streaming handlers keyed by the client-facing model name; add new models
+# here instead of branching in chat().
+MODELS = {
+    'claude-sonnet-3.7': stream_claude_sonnet,
+}
 
 # ==============================================================================
 # Flask Routes
 # ==============================================================================
 
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _precompress_index():
+    """Write index.html.br once at startup so / can serve it pre-compressed."""
+    try:
+        import brotli
+    except ImportError:
+        return
+    src = os.path.join(_APP_DIR, 'index.html')
+    dst = src + '.br'
+    try:
+        if not os.path.exists(dst) or os.path.getmtime(dst) < os.path.getmtime(src):
+            with open(src, 'rb') as f:
+                data = brotli.compress(f.read(), quality=11)
+            with open(dst, 'wb') as f:
+                f.write(data)
+    except OSError:
+        pass
+
+_precompress_index()
+
 @app.route("/")
 def index():
-    return send_file('index.html')
+    if 'br' in request.headers.get('Accept-Encoding', '') and os.path.exists(os.path.join(_APP_DIR, 'index.html.br')):
+        resp = send_from_directory(_APP_DIR, 'index.html.br', max_age=3600, conditional=True, mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'br'
+        resp.headers['Vary'] = 'Accept-Encoding'
+        return resp
+    return send_from_directory(_APP_DIR, 'index.html', max_age=3600, conditional=True)
 
 @app.route('/favicon.ico')
 def favicon():
     return '', 204
 
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+# Werkzeug enforces this during body parsing, so an oversized upload is
+# aborted mid-stream instead of being buffered and then rejected.
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+_IMAGE_EXTS = frozenset({'.png', '.jpg', '.jpeg'})
+_CODE_EXTS = frozenset({'.py', '.js', '.txt'})
+
+# Base64 of a multi-MB image is CPU-bound; run it off the request thread so
+# a big upload doesn't stall concurrent chat streams.
+_IO_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="upload")
+
+def _process_upload(raw, filename, mimetype):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in _IMAGE_EXTS:
+        width, height = _image_dimensions(raw)
+        base64_uri = (b"data:" + mimetype.encode('ascii') + b";base64," + _b64encode(raw)).decode('ascii')
+        return {
+            "id": str(uuid.uuid4()),
+            "name": filename,
+            "size": len(raw),
+            "width": width,
+            "height": height,
+            "fileType": mimetype,
+            "base64": base64_uri,
+            "type": "image"
+        }
+    if ext in _CODE_EXTS:
+        content = raw.decode('utf-8', 'replace')
+        return {
+            "id": str(uuid.uuid4()),
+            "name": filename,
+            "size": len(content),
+            "content": content,
+            "type": "code"
+        }
+    return None
+
+def _image_dimensions(image_bytes):
+    """Read (width, height) from the PNG/JPEG header without decoding pixels."""
+    if image_bytes[:8] == b'\x89PNG\r\n\x1a\n' and len(image_bytes) >= 24:
+        return struct.unpack('>II', image_bytes[16:24])
+    if image_bytes[:2] == b'\xff\xd8':
+        i = 2
+        n = len(image_bytes)
+        while i + 9 < n:
+            if image_bytes[i] != 0xFF:
+                i += 1
+                continue
+            marker = image_bytes[i + 1]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack('>HH', image_bytes[i + 5:i + 9])
+                return width, height
+            if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+                i += 2
+                continue
+            i += 2 + struct.unpack('>H', image_bytes[i + 2:i + 4])[0]
+    # Unrecognized header: let PIL parse incrementally, which reports the
+    # size as soon as the header is in without allocating the pixel buffer.
+    parser = ImageFile.Parser()
+    parser.feed(image_bytes[:65536])
+    if parser.image is not None:
+        return parser.image.size
+    return Image.open(io.BytesIO(image_bytes)).size
+
 @app.route("/upload_file", methods=["POST"])
 def upload_file():
+    # Check the declared length before touching request.files, which parses
+    # and buffers the whole multipart body.
+    if request.content_length and request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({"error": "File too large"}), 413
     if 'file' not in request.files:
         return jsonify({"error": "No file part"}), 400
     file = request.files['file']
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     try:
-        filename = file.filename.lower()
-        if filename.endswith(('.png', '.jpg', '.jpeg')):
-            image_bytes = file.read()
-            image = Image.open(io.BytesIO(image_bytes))
-            width, height = image.size
-            file.seek(0)
-            encoded_string = base64.b64encode(image_bytes).decode('utf-8')
-            mime_type = file.mimetype
-            base64_uri = f"data:{mime_type};base64,{encoded_string}"
-            return jsonify({
-                "id": str(uuid.uuid4()),
-                "name": file.filename,
-                "size": len(image_bytes),
-                "width": width,
-                "height": height,
-                "fileType": mime_type,
-                "base64": base64_uri,
-                "type": "image"
-            })
-        elif filename.endswith(('.py', '.js', '.txt')):
-            content = file.read().decode('utf-8')
-            return jsonify({
-                "id": str(uuid.uuid4()),
-                "name": file.filename,
-                "size": len(content),
-                "content": content,
-                "type": "code"
-            })
-        else:
+        raw = file.stream.read(MAX_UPLOAD_BYTES)
+        result = _IO_POOL.submit(_process_upload, raw, file.filename, file.mimetype).result()
+        if result is None:
             return jsonify({"error": "Unsupported file type. Use images (.png, .jpg, .jpeg) or code files (.py, .js, .txt)"}), 400
+        return jsonify(result)
     except Exception as e:
         return jsonify({"error": f"Failed to process file: {str(e)}"}), 500
 
@@ -257,7 +585,7 @@ def execute_code():
 @app.route("/chat", methods=["POST"])
 def chat():
     try:
-        image_data = None
+        image_bytes = None
         media_type = None
         if request.content_type.startswith('multipart/form-data'):
             data = request.form.to_dict()
@@ -265,7 +593,6 @@ def chat():
                 file = request.files.get('file')
                 if file and file.filename:
                     image_bytes = file.read()
-                    image_data = base64.b64encode(image_bytes).decode('utf-8')
                     media_type = file.mimetype
 
             if 'fileInfo' in data and data['fileInfo'] and data['fileInfo'] != 'null':
@@ -281,18 +608,25 @@ def chat():
         raw_reasoning = data.get("isReasoningEnabled", True)
         is_reasoning_enabled = str(raw_reasoning).lower() == 'true'
 
+        continue_last_line = None
         if action == "chat":
             text = data["text"]
             file_info = data.get("fileInfo")
-            user_message_to_save = f"[File: {file_info['name']}]\n{text}" if file_info and not image_data else text
-            save_msg(sid, "user", user_message_to_save, image_data=image_data, media_type=media_type)
-            chat_history = load_msgs(sid)
+            user_message_to_save = f"[File: {file_info['name']}]\n{text}" if file_info and not image_bytes else text
+            save_msg(sid, "user", user_message_to_save, image_bytes=image_bytes, media_type=media_type)
+            # Deferred: gen() loads the history once the response is already
+            # streaming, so the POST returns without an O(history) stall. The
+            # continue branch still loads it here because it validates and
+            # builds the continue prompt from the last bot message.
+            chat_history = None
         elif action == "continue":
             chat_history = load_msgs(sid)
             if chat_history and chat_history[-1]['role'] == 'assistant':
                 last_content = chat_history[-1]['content']
-                last_lines = '\n'.join(last_content.split('\n')[-3:])
-                last_line = last_content.split('\n')[-1].rstrip()
+                lines = last_content.split('\n')
+                last_lines = '\n'.join(lines[-3:])
+                last_line = lines[-1].rstrip()
+                continue_last_line = last_line
                 open_code_block = last_content.count('```') % 2 == 1
                 if open_code_block:
                     continue_content = (
@@ -320,33 +654,64 @@ def chat():
             return Response("Invalid action.", status=400)
 
         def gen():
-            buffer = ""
+            # Accumulate deltas as a list and join once at flush time; str +=
+            # re-copies the whole buffer per token.
+            parts = []
             code_block_open = False
+            # One row per bot turn: insert (or locate, for continuations) the
+            # target row up front, accumulate deltas in memory, and write the
+            # full message once when the stream drains.
+            bot_id = None
+            if action == "continue":
+                with _read() as db:
+                    # id is the AUTOINCREMENT rowid, so this walks the PK
+                    # index backwards with no sort step.
+                    row = db.execute("SELECT id FROM chats WHERE session_id=? AND role='bot' ORDER BY id DESC LIMIT 1", (sid,)).fetchone()
+                bot_id = row['id'] if row else None
             try:
-                if model == 'claude-sonnet-3.7':
-                    last_line = chat_history[-1]['content'].split('\n')[-1].rstrip() if action == "continue" and chat_history else None
-                    for chunk_text, is_code_block_open in stream_claude_sonnet(chat_history, is_reasoning_enabled, is_continuation=(action == "continue"), last_partial_line=last_line):
-                        buffer += chunk_text
+                handler = MODELS.get(model)
+                if handler is not None:
+                    history = load_msgs(sid) if chat_history is None else chat_history
+                    if action != "continue":
+                        # Created after the history load so a cache rebuild in
+                        # this request never covers the placeholder's rowid,
+                        # which would force the flush append to invalidate.
+                        with _write() as db:
+                            bot_id = db.execute("INSERT INTO chats(session_id, role, message) VALUES (?, 'bot', '')", (sid,)).lastrowid
+                    for chunk_text, is_code_block_open in handler(history, is_reasoning_enabled, is_continuation=(action == "continue"), last_partial_line=continue_last_line):
+                        parts.append(chunk_text)
                         code_block_open = is_code_block_open
                         yield chunk_text
                 else:
                     error_msg = f"🚫 The selected model '{model}' is not supported."
                     yield error_msg
-                    buffer = error_msg
-            except requests.exceptions.RequestException as e:
+                    parts = [error_msg]
+            except httpx.HTTPError as e:
                 error_msg = f"🤖 **Connection Error**\n\nI couldn't reach the AI service for model '{model}'. Details: {e}"
                 yield error_msg
-                buffer = error_msg
+                parts = [error_msg]
             except Exception as e:
                 error_msg = f"🤖 **System Error**\n\nUnexpected error: {str(e)}"
                 yield error_msg
-                buffer = error_msg
-            if buffer:
-                with app.app_context():
+                parts = [error_msg]
+            finally:
+                buffer = ''.join(parts)
+                with _write() as db:  # one transaction for the whole flush
+                    if buffer:
+                        if bot_id is not None:
+                            # Append in SQL; no need to have read the old text.
+                            db.execute("UPDATE chats SET message = message || ? WHERE id=?", (buffer, bot_id))
+                        else:
+                            bot_id = db.execute("INSERT INTO chats(session_id, role, message) VALUES (?, 'bot', ?)", (sid, buffer)).lastrowid
+                    elif action != "continue" and bot_id is not None:
+                        # Nothing streamed; drop the placeholder row.
+                        db.execute("DELETE FROM chats WHERE id=?", (bot_id,))
+                if buffer:
                     if action == "continue":
-                        update_last_bot_message(sid, buffer, code_block_open)
+                        # The cached last entry is stale; rebuild on next load.
+                        _cache_invalidate(sid)
                     else:
-                        save_msg(sid, "bot", buffer)
+                        _cache_append(sid, "bot", buffer, bot_id)
 
         return Response(stream_with_context(gen()), mimetype="text/plain; charset=utf-8")
     except Exception as e:
@@ -0,0 +1,19 @@
+import multiprocessing
+import os
+
+# Run with: gunicorn -c gunicorn_conf.py wsgi:app
+# The dev server (app.run) blocks one OS thread per in-flight Claude stream;
+# gevent turns each stream into a greenlet instead.
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+workers = max(2, multiprocessing.cpu_count())
+worker_class = "gevent"
+worker_connections = 1000
+raw_env = ["GEVENT_PATCH=1"]
+# Let the kernel load-balance accepts across workers and keep the heartbeat
+# tmpfiles off disk.
+reuse_port = True
+worker_tmp_dir = "/dev/shm"
+
+def post_fork(server, worker):
+    from app import init_db
+    init_db()
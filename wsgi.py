@@ -0,0 +1,4 @@
+from app import app
+
+# gunicorn -c gunicorn_conf.py wsgi:app
+# init_db runs per worker in the config's post_fork hook.